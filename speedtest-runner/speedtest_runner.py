@@ -7,15 +7,23 @@ Detects ISP changes by tracking external IP, ASN, and ISP name.
 Supports both InfluxDB 1.x (username/password) and 2.x (token-based) authentication.
 """
 
-import json
+import asyncio
+import logging
 import os
-import subprocess
+import random
+import re
+import signal
+import tempfile
 import time
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
+import orjson
 import requests
-import schedule
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # Configuration from environment
@@ -33,6 +41,155 @@ INFLUXDB_PASSWORD = os.getenv("INFLUXDB_PASSWORD", "")
 INFLUXDB_DATABASE = os.getenv("INFLUXDB_DATABASE", "netpulse")
 
 SPEEDTEST_INTERVAL = int(os.getenv("SPEEDTEST_INTERVAL", "1800"))  # 30 minutes default
+LOG_LEVEL = os.getenv("NETPULSE_LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("netpulse")
+
+# Separator line for log banners
+_RULE = "=" * 60
+
+# Connection type keywords, matched as substrings of the ISP name. Categories
+# are listed in priority order: the first one with a match wins.
+_CONNECTION_TYPE_KEYWORDS = (
+    ("cellular", frozenset({
+        "mobile", "cellular", "wireless", "lte", "5g",
+        "t-mobile", "verizon wireless", "at&t mobility",
+    })),
+    ("cable", frozenset({"cable", "comcast", "xfinity", "spectrum", "cox", "charter"})),
+    ("fiber", frozenset({"fiber", "fios", "att fiber", "google fiber"})),
+    ("dsl", frozenset({"dsl", "centurylink", "frontier"})),
+)
+
+# One named group per category. Each category is a lookahead over the whole
+# name, so the first category listed wins even when a later one matches
+# earlier in the string.
+_CONN_TYPE_RE = re.compile(
+    "|".join(
+        "(?=.*(?P<%s>%s))" % (name, "|".join(sorted(map(re.escape, keywords))))
+        for name, keywords in _CONNECTION_TYPE_KEYWORDS
+    ),
+    re.IGNORECASE | re.DOTALL
+)
+
+
+@lru_cache(maxsize=64)
+def _classify_connection_type(isp: str) -> str:
+    """Infer the connection type from the ISP name."""
+    match = _CONN_TYPE_RE.match(isp)
+    return match.lastgroup if match else "unknown"
+
+
+@dataclass(slots=True)
+class IPInfo:
+    """External IP address and ISP details for the current connection."""
+    ip: Optional[str] = None
+    isp: Optional[str] = None
+    asn: Optional[str] = None
+    org: Optional[str] = None
+    city: Optional[str] = None
+    region: Optional[str] = None
+    country: Optional[str] = None
+    connection_type: Optional[str] = None  # Inferred from the ISP name
+
+
+@dataclass(slots=True)
+class SpeedtestResult:
+    """Parsed output of a single Ookla speedtest run."""
+    timestamp: Optional[str] = None
+    ping_jitter: Optional[float] = None
+    ping_latency: Optional[float] = None
+    ping_low: Optional[float] = None
+    ping_high: Optional[float] = None
+    download_bandwidth: Optional[int] = None  # bytes/sec
+    download_bytes: Optional[int] = None
+    download_elapsed: Optional[int] = None
+    download_latency_iqm: Optional[float] = None
+    download_latency_low: Optional[float] = None
+    download_latency_high: Optional[float] = None
+    upload_bandwidth: Optional[int] = None  # bytes/sec
+    upload_bytes: Optional[int] = None
+    upload_elapsed: Optional[int] = None
+    upload_latency_iqm: Optional[float] = None
+    upload_latency_low: Optional[float] = None
+    upload_latency_high: Optional[float] = None
+    packet_loss: Optional[float] = None
+    server_id: Optional[int] = None
+    server_name: Optional[str] = None
+    server_location: Optional[str] = None
+    server_country: Optional[str] = None
+    server_host: Optional[str] = None
+    result_id: Optional[str] = None
+    result_url: Optional[str] = None
+    isp: Optional[str] = None
+    external_ip: Optional[str] = None
+    internal_ip: Optional[str] = None
+    download_mbps: float = 0.0
+    upload_mbps: float = 0.0
+
+
+# SpeedtestResult field -> key path in the Ookla CLI JSON output
+_SPEEDTEST_PATHS = {
+    "timestamp": ("timestamp",),
+    "ping_jitter": ("ping", "jitter"),
+    "ping_latency": ("ping", "latency"),
+    "ping_low": ("ping", "low"),
+    "ping_high": ("ping", "high"),
+    "download_bandwidth": ("download", "bandwidth"),
+    "download_bytes": ("download", "bytes"),
+    "download_elapsed": ("download", "elapsed"),
+    "download_latency_iqm": ("download", "latency", "iqm"),
+    "download_latency_low": ("download", "latency", "low"),
+    "download_latency_high": ("download", "latency", "high"),
+    "upload_bandwidth": ("upload", "bandwidth"),
+    "upload_bytes": ("upload", "bytes"),
+    "upload_elapsed": ("upload", "elapsed"),
+    "upload_latency_iqm": ("upload", "latency", "iqm"),
+    "upload_latency_low": ("upload", "latency", "low"),
+    "upload_latency_high": ("upload", "latency", "high"),
+    "packet_loss": ("packetLoss",),
+    "server_id": ("server", "id"),
+    "server_name": ("server", "name"),
+    "server_location": ("server", "location"),
+    "server_country": ("server", "country"),
+    "server_host": ("server", "host"),
+    "result_id": ("result", "id"),
+    "result_url": ("result", "url"),
+    "isp": ("isp",),
+    "external_ip": ("interface", "externalIp"),
+    "internal_ip": ("interface", "internalIp"),
+}
+
+
+def _dig(data, path: tuple, default=None):
+    """Follow a key path through nested dicts, returning default if any step is missing."""
+    for key in path:
+        if not isinstance(data, dict):
+            return default
+        data = data.get(key)
+        if data is None:
+            return default
+    return data
+
+
+def create_http_session() -> requests.Session:
+    """Create an HTTP session that keeps connections alive between requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "netpulse/1.0"
+    session.headers["Accept-Encoding"] = "gzip"
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+# Shared by the IP info lookups and the InfluxDB startup probe so that
+# connections (and TLS sessions) are reused across calls
+_HTTP = create_http_session()
 
 
 class ISPTracker:
@@ -41,6 +198,12 @@ class ISPTracker:
     # State file location - works for both local and Docker
     STATE_FILE = os.getenv("NETPULSE_STATE_FILE", "/tmp/netpulse_state.json")
     
+    # Per-request and overall timeouts (seconds) for the IP info lookups
+    IP_INFO_REQUEST_TIMEOUT = 10
+    IP_INFO_TIMEOUT = 12
+    # Both providers serve JSON; ask for it explicitly
+    IP_INFO_HEADERS = {"Accept": "application/json"}
+    
     def __init__(self):
         self.last_ip: Optional[str] = None
         self.last_isp: Optional[str] = None
@@ -49,23 +212,32 @@ class ISPTracker:
         
         # Load persisted state from file
         self._load_state()
+        
+        # Last state written to disk, used to skip rewriting unchanged state
+        self._last_saved = (self.last_ip, self.last_isp, self.last_asn, self.last_connection_type)
     
     def _load_state(self):
         """Load previous ISP state from file."""
         try:
-            if os.path.exists(self.STATE_FILE):
-                with open(self.STATE_FILE, 'r') as f:
-                    state = json.load(f)
-                    self.last_ip = state.get("ip")
-                    self.last_isp = state.get("isp")
-                    self.last_asn = state.get("asn")
-                    self.last_connection_type = state.get("connection_type")
-                    print(f"Loaded previous state: IP={self.last_ip}, ISP={self.last_isp}")
+            with open(self.STATE_FILE, 'rb') as f:
+                state = orjson.loads(f.read())
+            self.last_ip = state.get("ip")
+            self.last_isp = state.get("isp")
+            self.last_asn = state.get("asn")
+            self.last_connection_type = state.get("connection_type")
+            logger.info("Loaded previous state: IP=%s, ISP=%s", self.last_ip, self.last_isp)
+        except FileNotFoundError:
+            pass  # First run, no previous state
         except Exception as e:
-            print(f"Could not load previous state: {e}")
+            logger.warning("Could not load previous state: %s", e)
     
     def _save_state(self):
-        """Save current ISP state to file for persistence."""
+        """Save current ISP state to file for persistence, if it changed."""
+        key = (self.last_ip, self.last_isp, self.last_asn, self.last_connection_type)
+        if key == self._last_saved:
+            return
+        
+        tmp_file = None
         try:
             state = {
                 "ip": self.last_ip,
@@ -74,82 +246,122 @@ class ISPTracker:
                 "connection_type": self.last_connection_type,
                 "updated_at": datetime.now().isoformat()
             }
-            with open(self.STATE_FILE, 'w') as f:
-                json.dump(state, f)
+            # Write to a uniquely named temporary file in one write() call,
+            # sync it and rename it into place, so the state file is never
+            # left truncated (even with overlapping --once runs)
+            fd, tmp_file = tempfile.mkstemp(
+                dir=os.path.dirname(self.STATE_FILE) or ".",
+                prefix=".netpulse_state."
+            )
+            try:
+                os.write(fd, orjson.dumps(state))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_file, self.STATE_FILE)
+            self._last_saved = key
         except Exception as e:
-            print(f"Could not save state: {e}")
+            logger.warning("Could not save state: %s", e)
+            if tmp_file:
+                try:
+                    os.unlink(tmp_file)
+                except OSError:
+                    pass
     
-    def get_ip_info(self) -> dict:
+    async def get_ip_info(self) -> IPInfo:
         """
         Get current external IP and ISP information.
         Uses multiple services for redundancy.
         """
-        ip_info = {
-            "ip": None,
-            "isp": None,
-            "asn": None,
-            "org": None,
-            "city": None,
-            "region": None,
-            "country": None,
-            "connection_type": None  # Will be inferred
+        # Query both services concurrently (no API key needed for basic
+        # info). Results are taken in priority order so the ISP name stays
+        # consistent between cycles (the services name ISPs differently);
+        # the fallback is already in flight if the preferred service fails.
+        fetchers = {
+            "ipinfo.io": self._fetch_ipinfo,
+            "ip-api.com": self._fetch_ip_api,
         }
-        
-        # Try ipinfo.io first (no API key needed for basic info)
+        tasks = {
+            name: asyncio.create_task(asyncio.to_thread(fetch))
+            for name, fetch in fetchers.items()
+        }
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.IP_INFO_TIMEOUT
+        ip_info = None
         try:
-            response = requests.get("https://ipinfo.io/json", timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                ip_info["ip"] = data.get("ip")
-                ip_info["org"] = data.get("org", "")  # Contains ASN and org name
-                ip_info["city"] = data.get("city")
-                ip_info["region"] = data.get("region")
-                ip_info["country"] = data.get("country")
-                
-                # Parse ASN from org field (format: "AS12345 Company Name")
-                org = data.get("org", "")
-                if org.startswith("AS"):
-                    parts = org.split(" ", 1)
-                    ip_info["asn"] = parts[0]
-                    ip_info["isp"] = parts[1] if len(parts) > 1 else org
-                else:
-                    ip_info["isp"] = org
-        except Exception as e:
-            print(f"Error fetching from ipinfo.io: {e}")
+            for name, task in tasks.items():
+                try:
+                    ip_info = await asyncio.wait_for(task, timeout=max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    logger.warning("Timed out fetching from %s", name)
+                except Exception as e:
+                    logger.warning("Error fetching from %s: %s", name, e)
+                if ip_info and ip_info.ip:
+                    break
+        finally:
+            for task in tasks.values():
+                task.cancel()
         
-        # Fallback to ip-api.com if ipinfo.io failed
-        if not ip_info["ip"]:
-            try:
-                response = requests.get("http://ip-api.com/json", timeout=10)
-                if response.status_code == 200:
-                    data = response.json()
-                    ip_info["ip"] = data.get("query")
-                    ip_info["isp"] = data.get("isp")
-                    ip_info["asn"] = data.get("as", "").split(" ")[0] if data.get("as") else None
-                    ip_info["org"] = data.get("org")
-                    ip_info["city"] = data.get("city")
-                    ip_info["region"] = data.get("regionName")
-                    ip_info["country"] = data.get("countryCode")
-            except Exception as e:
-                print(f"Error fetching from ip-api.com: {e}")
+        if not (ip_info and ip_info.ip):
+            ip_info = IPInfo()
         
         # Infer connection type based on ISP name keywords
-        if ip_info["isp"]:
-            isp_lower = ip_info["isp"].lower()
-            if any(kw in isp_lower for kw in ["mobile", "cellular", "wireless", "lte", "5g", "t-mobile", "verizon wireless", "at&t mobility"]):
-                ip_info["connection_type"] = "cellular"
-            elif any(kw in isp_lower for kw in ["cable", "comcast", "xfinity", "spectrum", "cox", "charter"]):
-                ip_info["connection_type"] = "cable"
-            elif any(kw in isp_lower for kw in ["fiber", "fios", "att fiber", "google fiber"]):
-                ip_info["connection_type"] = "fiber"
-            elif any(kw in isp_lower for kw in ["dsl", "centurylink", "frontier"]):
-                ip_info["connection_type"] = "dsl"
-            else:
-                ip_info["connection_type"] = "unknown"
+        if ip_info.isp:
+            ip_info.connection_type = _classify_connection_type(ip_info.isp)
         
         return ip_info
     
-    def check_for_change(self, current_info: dict) -> dict:
+    @classmethod
+    def _fetch_ipinfo(cls) -> Optional[IPInfo]:
+        """Fetch IP info from ipinfo.io."""
+        response = _HTTP.get(
+            "https://ipinfo.io/json",
+            headers=cls.IP_INFO_HEADERS,
+            timeout=cls.IP_INFO_REQUEST_TIMEOUT
+        )
+        if response.status_code != 200:
+            return None
+        data = orjson.loads(response.content)
+        ip_info = IPInfo(
+            ip=data.get("ip"),
+            org=data.get("org", ""),  # Contains ASN and org name
+            city=data.get("city"),
+            region=data.get("region"),
+            country=data.get("country")
+        )
+        
+        # Parse ASN from org field (format: "AS12345 Company Name")
+        org = data.get("org", "")
+        if org.startswith("AS"):
+            asn, sep, rest = org.partition(" ")
+            ip_info.asn = asn
+            ip_info.isp = rest if sep else org
+        else:
+            ip_info.isp = org
+        return ip_info
+    
+    @classmethod
+    def _fetch_ip_api(cls) -> Optional[IPInfo]:
+        """Fetch IP info from ip-api.com."""
+        response = _HTTP.get(
+            "http://ip-api.com/json",
+            headers=cls.IP_INFO_HEADERS,
+            timeout=cls.IP_INFO_REQUEST_TIMEOUT
+        )
+        if response.status_code != 200:
+            return None
+        data = orjson.loads(response.content)
+        return IPInfo(
+            ip=data.get("query"),
+            isp=data.get("isp"),
+            asn=(data.get("as") or "").partition(" ")[0] or None,
+            org=data.get("org"),
+            city=data.get("city"),
+            region=data.get("regionName"),
+            country=data.get("countryCode")
+        )
+    
+    def check_for_change(self, current_info: IPInfo) -> dict:
         """
         Check if ISP has changed since last check.
         Returns change information if detected.
@@ -165,10 +377,10 @@ class ISPTracker:
             "previous_connection_type": self.last_connection_type
         }
         
-        current_ip = current_info.get("ip")
-        current_isp = current_info.get("isp")
-        current_asn = current_info.get("asn")
-        current_connection_type = current_info.get("connection_type")
+        current_ip = current_info.ip
+        current_isp = current_info.isp
+        current_asn = current_info.asn
+        current_connection_type = current_info.connection_type
         
         # Check for changes (only if we have previous values)
         if self.last_ip is not None:
@@ -199,9 +411,16 @@ class ISPTracker:
 class InfluxDBWriter:
     """Abstract base class for InfluxDB writers."""
     
+    # Whether write_points only queues points for a background flush
+    buffered = False
+    
+    def write_points(self, points: list):
+        """Write (measurement, tags, fields) tuples to InfluxDB in one request."""
+        raise NotImplementedError
+    
     def write_point(self, measurement: str, tags: dict, fields: dict):
         """Write a data point to InfluxDB."""
-        raise NotImplementedError
+        self.write_points([(measurement, tags, fields)])
     
     def close(self):
         """Close the connection."""
@@ -211,29 +430,58 @@ class InfluxDBWriter:
 class InfluxDB2Writer(InfluxDBWriter):
     """Writer for InfluxDB 2.x using token-based authentication."""
     
+    buffered = True
+    
     def __init__(self, url: str, token: str, org: str, bucket: str):
-        from influxdb_client import InfluxDBClient
-        from influxdb_client.client.write_api import SYNCHRONOUS
+        from influxdb_client import InfluxDBClient, Point
+        from influxdb_client.client.write_api import WriteOptions
         
+        # Kept on the instance so write_points doesn't re-import it per call
+        self._Point = Point
         self.bucket = bucket
         self.client = InfluxDBClient(url=url, token=token, org=org)
-        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
-        print(f"Connected to InfluxDB 2.x at {url} (org: {org}, bucket: {bucket})")
+        # Batching write API: points are buffered and flushed as a single
+        # HTTP request instead of one round trip per point. The flush happens
+        # in the background, so its outcome is only known in the callbacks.
+        self.write_api = self.client.write_api(
+            write_options=WriteOptions(
+                batch_size=500,
+                flush_interval=1_000,
+                jitter_interval=200,
+                retry_interval=5_000,
+                max_retries=3
+            ),
+            success_callback=self._on_write_success,
+            error_callback=self._on_write_error
+        )
+        logger.info("Connected to InfluxDB 2.x at %s (org: %s, bucket: %s)", url, org, bucket)
     
-    def write_point(self, measurement: str, tags: dict, fields: dict):
-        from influxdb_client import Point
-        
-        point = Point(measurement)
-        for key, value in tags.items():
-            if value is not None:
-                point = point.tag(key, str(value))
-        for key, value in fields.items():
-            if value is not None:
-                point = point.field(key, value)
+    @staticmethod
+    def _on_write_success(conf: tuple, data):
+        logger.info("  Results written to InfluxDB")
+    
+    @staticmethod
+    def _on_write_error(conf: tuple, data, exception: Exception):
+        logger.error("Error writing to InfluxDB: %s", exception)
+    
+    def write_points(self, points: list):
+        # Serialize to line protocol up front; the write API sends strings
+        # as-is instead of converting each Point again when batching
+        records = []
+        for measurement, tags, fields in points:
+            line = self._Point.from_dict({
+                "measurement": measurement,
+                "tags": {k: str(v) for k, v in tags.items() if v is not None},
+                "fields": {k: v for k, v in fields.items() if v is not None}
+            }).to_line_protocol()
+            if line:  # Points without fields serialize to nothing
+                records.append(line)
         
-        self.write_api.write(bucket=self.bucket, record=point)
+        self.write_api.write(bucket=self.bucket, record=records)
     
     def close(self):
+        # Closing the write API flushes any buffered points
+        self.write_api.close()
         self.client.close()
 
 
@@ -266,19 +514,19 @@ class InfluxDB1Writer(InfluxDBWriter):
         except Exception:
             pass  # Database might already exist
         
-        print(f"Connected to InfluxDB 1.x at {host}:{port} (database: {database})")
+        logger.info("Connected to InfluxDB 1.x at %s:%s (database: %s)", host, port, database)
     
-    def write_point(self, measurement: str, tags: dict, fields: dict):
+    def write_points(self, points: list):
         # Filter out None values
-        clean_tags = {k: str(v) for k, v in tags.items() if v is not None}
-        clean_fields = {k: v for k, v in fields.items() if v is not None}
-        
-        point = {
-            "measurement": measurement,
-            "tags": clean_tags,
-            "fields": clean_fields
-        }
-        self.client.write_points([point])
+        records = [
+            {
+                "measurement": measurement,
+                "tags": {k: str(v) for k, v in tags.items() if v is not None},
+                "fields": {k: v for k, v in fields.items() if v is not None}
+            }
+            for measurement, tags, fields in points
+        ]
+        self.client.write_points(records)
     
     def close(self):
         self.client.close()
@@ -311,219 +559,293 @@ def create_influxdb_writer() -> InfluxDBWriter:
 class SpeedtestRunner:
     """Runs speedtests and logs results to InfluxDB."""
     
+    # Written by the Ookla CLI once the license and GDPR terms are accepted
+    SPEEDTEST_CONFIG_FILE = os.path.expanduser("~/.config/ookla/speedtest-cli.json")
+    
     def __init__(self):
         self.writer = create_influxdb_writer()
         self.isp_tracker = ISPTracker()
-        self.speedtest_accepted_license = False
+        
+        # Only pass the accept flags until the CLI has persisted acceptance
+        self.accept_license = not os.path.exists(self.SPEEDTEST_CONFIG_FILE)
+        
+        # Speedtest tags rarely change between cycles; keep the last set
+        self._tag_cache_key: Optional[tuple] = None
+        self._tag_cache: dict = {}
     
-    def accept_speedtest_license(self):
-        """Accept the Ookla speedtest license on first run."""
-        if not self.speedtest_accepted_license:
-            try:
-                # Accept the license by running with --accept-license
-                subprocess.run(
-                    ["speedtest", "--accept-license", "--accept-gdpr"],
-                    capture_output=True,
-                    text=True,
-                    timeout=30
-                )
-                self.speedtest_accepted_license = True
-            except Exception as e:
-                print(f"Error accepting speedtest license: {e}")
+    async def _exec_speedtest(self, accept_license: bool) -> tuple:
+        """Run the speedtest CLI once, returning (returncode, stdout, stderr)."""
+        args = ["speedtest", "--format=json"]
+        if accept_license:
+            args += ["--accept-license", "--accept-gdpr"]
+        
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,  # Never block on the license prompt
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate(),
+                timeout=120  # 2 minute timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Don't leave the speedtest running on timeout or shutdown
+            proc.kill()
+            await proc.wait()
+            raise
+        return proc.returncode, stdout, stderr
     
-    def run_speedtest(self) -> Optional[dict]:
+    async def run_speedtest(self) -> Optional[SpeedtestResult]:
         """
         Run speedtest using Ookla's official CLI.
         Returns parsed results or None if failed.
         """
-        self.accept_speedtest_license()
-        
         try:
-            print(f"[{datetime.now().isoformat()}] Starting speedtest...")
-            result = subprocess.run(
-                ["speedtest", "--format=json", "--accept-license", "--accept-gdpr"],
-                capture_output=True,
-                text=True,
-                timeout=120  # 2 minute timeout
-            )
+            logger.info("Starting speedtest...")
+            started = time.perf_counter()
+            returncode, stdout, stderr = await self._exec_speedtest(self.accept_license)
+            
+            if returncode != 0 and not self.accept_license:
+                # The stored acceptance may be stale or unreadable; retry
+                # once with the accept flags
+                logger.warning("Speedtest failed without license flags, retrying with them")
+                self.accept_license = True
+                returncode, stdout, stderr = await self._exec_speedtest(True)
             
-            if result.returncode != 0:
-                print(f"Speedtest failed: {result.stderr}")
+            if returncode != 0:
+                logger.error("Speedtest failed: %s", stderr.decode(errors="replace"))
                 return None
             
-            data = json.loads(result.stdout)
+            # Keep passing the flags until the CLI has actually persisted
+            # acceptance (e.g. the config directory may not be writable)
+            self.accept_license = not os.path.exists(self.SPEEDTEST_CONFIG_FILE)
+            
+            data = orjson.loads(stdout)
             
             # Parse results
-            speedtest_result = {
-                "timestamp": data.get("timestamp"),
-                "ping_jitter": data.get("ping", {}).get("jitter"),
-                "ping_latency": data.get("ping", {}).get("latency"),
-                "ping_low": data.get("ping", {}).get("low"),
-                "ping_high": data.get("ping", {}).get("high"),
-                "download_bandwidth": data.get("download", {}).get("bandwidth"),  # bytes/sec
-                "download_bytes": data.get("download", {}).get("bytes"),
-                "download_elapsed": data.get("download", {}).get("elapsed"),
-                "download_latency_iqm": data.get("download", {}).get("latency", {}).get("iqm"),
-                "download_latency_low": data.get("download", {}).get("latency", {}).get("low"),
-                "download_latency_high": data.get("download", {}).get("latency", {}).get("high"),
-                "upload_bandwidth": data.get("upload", {}).get("bandwidth"),  # bytes/sec
-                "upload_bytes": data.get("upload", {}).get("bytes"),
-                "upload_elapsed": data.get("upload", {}).get("elapsed"),
-                "upload_latency_iqm": data.get("upload", {}).get("latency", {}).get("iqm"),
-                "upload_latency_low": data.get("upload", {}).get("latency", {}).get("low"),
-                "upload_latency_high": data.get("upload", {}).get("latency", {}).get("high"),
-                "packet_loss": data.get("packetLoss"),
-                "server_id": data.get("server", {}).get("id"),
-                "server_name": data.get("server", {}).get("name"),
-                "server_location": data.get("server", {}).get("location"),
-                "server_country": data.get("server", {}).get("country"),
-                "server_host": data.get("server", {}).get("host"),
-                "result_id": data.get("result", {}).get("id"),
-                "result_url": data.get("result", {}).get("url"),
-                "isp": data.get("isp"),
-                "external_ip": data.get("interface", {}).get("externalIp"),
-                "internal_ip": data.get("interface", {}).get("internalIp"),
-            }
+            speedtest_result = SpeedtestResult(
+                **{name: _dig(data, path) for name, path in _SPEEDTEST_PATHS.items()}
+            )
             
             # Convert bandwidth from bytes/sec to Mbps for readability
-            if speedtest_result["download_bandwidth"]:
-                speedtest_result["download_mbps"] = (speedtest_result["download_bandwidth"] * 8) / 1_000_000
-            if speedtest_result["upload_bandwidth"]:
-                speedtest_result["upload_mbps"] = (speedtest_result["upload_bandwidth"] * 8) / 1_000_000
+            if speedtest_result.download_bandwidth:
+                speedtest_result.download_mbps = (speedtest_result.download_bandwidth * 8) / 1_000_000
+            if speedtest_result.upload_bandwidth:
+                speedtest_result.upload_mbps = (speedtest_result.upload_bandwidth * 8) / 1_000_000
             
-            print(f"  Download: {speedtest_result.get('download_mbps', 0):.2f} Mbps")
-            print(f"  Upload: {speedtest_result.get('upload_mbps', 0):.2f} Mbps")
-            print(f"  Ping: {speedtest_result.get('ping_latency', 0):.2f} ms")
-            print(f"  Jitter: {speedtest_result.get('ping_jitter', 0):.2f} ms")
+            logger.info(
+                "Speedtest took %.2f s\n"
+                "  Download: %.2f Mbps\n  Upload: %.2f Mbps\n  Ping: %.2f ms\n  Jitter: %.2f ms",
+                time.perf_counter() - started,
+                speedtest_result.download_mbps,
+                speedtest_result.upload_mbps,
+                speedtest_result.ping_latency or 0,
+                speedtest_result.ping_jitter or 0
+            )
             
             return speedtest_result
             
-        except subprocess.TimeoutExpired:
-            print("Speedtest timed out")
+        except asyncio.TimeoutError:
+            logger.error("Speedtest timed out")
+            # Accept the terms again next time in case that is what hung
+            self.accept_license = True
             return None
-        except json.JSONDecodeError as e:
-            print(f"Failed to parse speedtest output: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Failed to parse speedtest output: %s", e)
             return None
         except Exception as e:
-            print(f"Error running speedtest: {e}")
+            logger.error("Error running speedtest: %s", e)
             return None
     
-    def write_speedtest_result(self, result: dict, ip_info: dict, isp_change: dict):
+    async def write_speedtest_result(self, result: SpeedtestResult, ip_info: IPInfo, isp_change: dict):
         """Write speedtest results to InfluxDB."""
         try:
-            # Main speedtest metrics
-            tags = {
-                "server_name": result.get("server_name", "unknown"),
-                "server_location": result.get("server_location", "unknown"),
-                "server_country": result.get("server_country", "unknown"),
-                "isp": ip_info.get("isp", result.get("isp", "unknown")),
-                "asn": ip_info.get("asn", "unknown"),
-                "connection_type": ip_info.get("connection_type", "unknown"),
-                "external_ip": ip_info.get("ip", result.get("external_ip", "unknown")),
-            }
+            # Main speedtest metrics (tags are rebuilt only when the server
+            # or connection changes)
+            isp = ip_info.isp or result.isp or "unknown"
+            external_ip = ip_info.ip or result.external_ip or "unknown"
+            tag_key = (result.server_id, isp, ip_info.asn, ip_info.connection_type, external_ip)
+            if tag_key != self._tag_cache_key:
+                self._tag_cache = {
+                    "server_name": result.server_name or "unknown",
+                    "server_location": result.server_location or "unknown",
+                    "server_country": result.server_country or "unknown",
+                    "isp": isp,
+                    "asn": ip_info.asn or "unknown",
+                    "connection_type": ip_info.connection_type or "unknown",
+                    "external_ip": external_ip,
+                }
+                self._tag_cache_key = tag_key
+            tags = self._tag_cache
+            changed = isp_change.get("changed")
             fields = {
-                "download_mbps": result.get("download_mbps", 0.0),
-                "upload_mbps": result.get("upload_mbps", 0.0),
-                "download_bandwidth": result.get("download_bandwidth", 0),
-                "upload_bandwidth": result.get("upload_bandwidth", 0),
-                "ping_latency": result.get("ping_latency", 0.0),
-                "ping_jitter": result.get("ping_jitter", 0.0),
-                "ping_low": result.get("ping_low", 0.0),
-                "ping_high": result.get("ping_high", 0.0),
-                "download_latency_iqm": result.get("download_latency_iqm", 0.0),
-                "upload_latency_iqm": result.get("upload_latency_iqm", 0.0),
-                "packet_loss": result.get("packet_loss") if result.get("packet_loss") is not None else 0.0,
-                "result_url": result.get("result_url", ""),
+                "download_mbps": result.download_mbps,
+                "upload_mbps": result.upload_mbps,
+                "download_bandwidth": result.download_bandwidth,
+                "upload_bandwidth": result.upload_bandwidth,
+                "ping_latency": result.ping_latency,
+                "ping_jitter": result.ping_jitter,
+                "ping_low": result.ping_low,
+                "ping_high": result.ping_high,
+                "download_latency_iqm": result.download_latency_iqm,
+                "upload_latency_iqm": result.upload_latency_iqm,
+                "packet_loss": pl if (pl := result.packet_loss) is not None else 0.0,
+                "result_url": result.result_url,
+                # ISP change marker, so changes can also be filtered from
+                # the speedtest measurement itself
+                "isp_change_event": 1 if changed else 0,
+                "previous_isp": isp_change.get("previous_isp") if changed else None,
             }
             
-            self.writer.write_point("speedtest", tags, fields)
+            points = [("speedtest", tags, fields)]
             
-            # Write ISP change event if detected
-            if isp_change.get("changed"):
+            # Write ISP change event if detected (drives the dashboard's
+            # annotations and ISP change table)
+            if changed:
                 change_tags = {
                     "previous_isp": isp_change.get("previous_isp", "unknown"),
-                    "current_isp": ip_info.get("isp", "unknown"),
+                    "current_isp": ip_info.isp or "unknown",
                     "previous_asn": isp_change.get("previous_asn", "unknown"),
-                    "current_asn": ip_info.get("asn", "unknown"),
+                    "current_asn": ip_info.asn or "unknown",
                     "previous_connection_type": isp_change.get("previous_connection_type", "unknown"),
-                    "current_connection_type": ip_info.get("connection_type", "unknown"),
+                    "current_connection_type": ip_info.connection_type or "unknown",
                 }
                 change_fields = {
                     "ip_changed": isp_change.get("ip_changed", False),
                     "isp_changed": isp_change.get("isp_changed", False),
                     "asn_changed": isp_change.get("asn_changed", False),
                     "previous_ip": isp_change.get("previous_ip", ""),
-                    "current_ip": ip_info.get("ip", ""),
+                    "current_ip": ip_info.ip or "",
                     "event": 1,  # Marker for annotations
                 }
                 
-                self.writer.write_point("isp_change", change_tags, change_fields)
-                print(f"  ⚠️  ISP CHANGE DETECTED: {isp_change.get('previous_isp')} -> {ip_info.get('isp')}")
+                points.append(("isp_change", change_tags, change_fields))
+                logger.warning("  ⚠️  ISP CHANGE DETECTED: %s -> %s", isp_change.get("previous_isp"), ip_info.isp)
             
-            print(f"  Results written to InfluxDB")
+            # Send both points in a single request
+            await asyncio.to_thread(self.writer.write_points, points)
+            if self.writer.buffered:
+                # The writer logs the outcome once the batch is flushed
+                logger.info("  Results queued for InfluxDB")
+            else:
+                logger.info("  Results written to InfluxDB")
             
         except Exception as e:
-            print(f"Error writing to InfluxDB: {e}")
+            logger.error("Error writing to InfluxDB: %s", e)
     
-    def run_test_cycle(self):
+    async def run_test_cycle(self):
         """Run a complete test cycle: get IP info, run speedtest, log results."""
-        print(f"\n{'='*60}")
-        print(f"[{datetime.now().isoformat()}] Starting test cycle")
-        print(f"{'='*60}")
+        logger.info("%s\nStarting test cycle\n%s", _RULE, _RULE)
+        started = time.perf_counter()
         
         # Get current IP/ISP information
-        ip_info = self.isp_tracker.get_ip_info()
-        print(f"  External IP: {ip_info.get('ip')}")
-        print(f"  ISP: {ip_info.get('isp')}")
-        print(f"  ASN: {ip_info.get('asn')}")
-        print(f"  Connection Type: {ip_info.get('connection_type')}")
+        ip_info = await self.isp_tracker.get_ip_info()
+        logger.info(
+            "  External IP: %s\n  ISP: %s\n  ASN: %s\n  Connection Type: %s",
+            ip_info.ip, ip_info.isp, ip_info.asn, ip_info.connection_type
+        )
         
         # Check for ISP change
         isp_change = self.isp_tracker.check_for_change(ip_info)
         
         # Run speedtest
-        result = self.run_speedtest()
+        result = await self.run_speedtest()
         
         if result:
-            self.write_speedtest_result(result, ip_info, isp_change)
+            await self.write_speedtest_result(result, ip_info, isp_change)
         else:
             # Write at least the IP info if speedtest failed
             try:
                 tags = {
-                    "isp": ip_info.get("isp", "unknown"),
-                    "connection_type": ip_info.get("connection_type", "unknown"),
+                    "isp": ip_info.isp or "unknown",
+                    "connection_type": ip_info.connection_type or "unknown",
                 }
                 fields = {"error": 1}
-                self.writer.write_point("speedtest_error", tags, fields)
+                await asyncio.to_thread(self.writer.write_point, "speedtest_error", tags, fields)
             except Exception as e:
-                print(f"Error logging speedtest failure: {e}")
+                logger.error("Error logging speedtest failure: %s", e)
         
-        print(f"[{datetime.now().isoformat()}] Test cycle complete")
-        print(f"Next test in {SPEEDTEST_INTERVAL} seconds ({SPEEDTEST_INTERVAL/60:.1f} minutes)")
+        logger.info("Test cycle complete in %.2f s", time.perf_counter() - started)
 
 
-def wait_for_influxdb():
-    """Wait for InfluxDB to be ready."""
-    print("Waiting for InfluxDB to be ready...")
-    max_retries = 30
-    retry_interval = 5
+async def wait_for_influxdb(timeout: float = 150):
+    """Wait for InfluxDB to be ready, polling with exponential backoff."""
+    logger.info("Waiting for InfluxDB to be ready...")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = 0.1
+    attempt = 0
     
-    for i in range(max_retries):
+    while True:
+        attempt += 1
         try:
-            response = requests.get(f"{INFLUXDB_URL}/health", timeout=5)
-            if response.status_code == 200:
-                print("InfluxDB is ready!")
+            # /ping is the cheapest endpoint on both 1.x and 2.x; any
+            # non-5xx answer (e.g. 401 with ping auth) means it is up
+            response = await asyncio.to_thread(_HTTP.get, f"{INFLUXDB_URL}/ping", timeout=2)
+            if response.status_code < 500:
+                logger.info("InfluxDB is ready!")
                 return True
         except Exception:
             pass
         
-        print(f"  Waiting... ({i+1}/{max_retries})")
-        time.sleep(retry_interval)
+        # Up to 10% jitter so several runners starting together don't
+        # probe in lockstep
+        sleep_for = delay + random.uniform(0, 0.1 * delay)  # nosec B311 - not security related
+        if loop.time() + sleep_for > deadline:
+            break
+        logger.info("  Waiting... (attempt %d)", attempt)
+        await asyncio.sleep(sleep_for)
+        delay = min(delay * 1.7, 2.0)
     
-    print("Failed to connect to InfluxDB")
+    logger.error("Failed to connect to InfluxDB")
     return False
 
 
+async def run(once: bool, interval: int):
+    """Run the test cycle once, or forever at the given interval."""
+    # Stop cleanly on SIGTERM (docker stop, systemctl stop): cancelling the
+    # task interrupts any wait or running speedtest, and the writer is still
+    # closed so buffered points are flushed
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    
+    try:
+        # Wait for InfluxDB
+        if not await wait_for_influxdb():
+            return
+        
+        # Create runner
+        runner = SpeedtestRunner()
+        
+        try:
+            loop = asyncio.get_running_loop()
+            next_run = loop.time()
+            
+            # Run initial test
+            await runner.run_test_cycle()
+            
+            # If --once flag, exit after single run
+            if once:
+                logger.info("Single run completed. Exiting.")
+                return
+            
+            # Run periodic tests (daemon mode). Deadlines are kept on the
+            # loop's monotonic clock so cycle duration doesn't add drift; a
+            # cycle that overruns the interval is followed immediately.
+            while True:
+                next_run = max(next_run + interval, loop.time())
+                delay = next_run - loop.time()
+                logger.info("Next test in %.0f seconds (%.1f minutes)", delay, delay / 60)
+                await asyncio.sleep(delay)
+                await runner.run_test_cycle()
+        finally:
+            # Flush buffered points before exiting
+            runner.writer.close()
+    except asyncio.CancelledError:
+        logger.info("Stopped.")
+
+
 def main():
     """Main entry point."""
     import argparse
@@ -553,40 +875,23 @@ Examples:
     
     interval = args.interval if args.interval else SPEEDTEST_INTERVAL
     
-    print("="*60)
-    print("NetPulse - Network Speed & ISP Monitor")
-    print("="*60)
-    print(f"InfluxDB URL: {INFLUXDB_URL}")
-    print(f"InfluxDB Org: {INFLUXDB_ORG}")
-    print(f"InfluxDB Bucket: {INFLUXDB_BUCKET}")
-    if args.once:
-        print("Mode: Single run (--once)")
-    else:
-        print(f"Test Interval: {interval} seconds ({interval/60:.1f} minutes)")
-    print("="*60)
-    
-    # Wait for InfluxDB
-    if not wait_for_influxdb():
-        return
-    
-    # Create runner
-    runner = SpeedtestRunner()
-    
-    # Run initial test
-    runner.run_test_cycle()
-    
-    # If --once flag, exit after single run
-    if args.once:
-        print("Single run completed. Exiting.")
-        return
-    
-    # Schedule periodic tests (daemon mode)
-    schedule.every(interval).seconds.do(runner.run_test_cycle)
-    
-    # Run scheduler
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        format="%(asctime)s %(levelname)s %(message)s"
+    )
+    
+    if logger.isEnabledFor(logging.INFO):
+        if args.once:
+            mode = "Mode: Single run (--once)"
+        else:
+            mode = f"Test Interval: {interval} seconds ({interval / 60:.1f} minutes)"
+        logger.info(
+            "%s\nNetPulse - Network Speed & ISP Monitor\n%s\n"
+            "InfluxDB URL: %s\nInfluxDB Org: %s\nInfluxDB Bucket: %s\n%s\n%s",
+            _RULE, _RULE, INFLUXDB_URL, INFLUXDB_ORG, INFLUXDB_BUCKET, mode, _RULE
+        )
+    
+    asyncio.run(run(args.once, interval))
 
 
 if __name__ == "__main__":